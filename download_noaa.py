@@ -1,37 +1,84 @@
 import pandas as pd
 import subprocess
+import tempfile
 import os
+import random
 import requests
-import gzip
-import shutil
-from time import sleep
-from concurrent.futures import ThreadPoolExecutor, as_completed
+import threading
+import time
+import urllib3
+from contextlib import contextmanager, suppress
+from datetime import date, timedelta
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
+from requests.adapters import HTTPAdapter
+
+# Use the ISA-L accelerated inflate if the optional isal package is installed.
+# It is a drop-in replacement for zlib, so fall back to the standard library.
+try:
+    from isal import isal_zlib as zlib
+except ImportError:
+    import zlib
 
 
 # Set the path for the crx2rnx executable. 
 CRX2RNX_EXE_PATH = Path(__file__).with_name("CRX2RNX")
 
-# Error handling: ensure you have the file with the right permissions.
-assert CRX2RNX_EXE_PATH.is_file(), f"{CRX2RNX_EXE_PATH} not found. Did you copy the executable here?"
-assert os.access(CRX2RNX_EXE_PATH, os.X_OK), f"{CRX2RNX_EXE_PATH} is not executable. Please set the permissions for this file"
-    
-
-def is_url_available(url, retries=3, delay=5):
-    """Check whether a URL is available, with retries.
-
-    I was getting errors when trying to download files, so this function
-    tries the request multiple times and waits between attempts. The idea
-    is to give the server a chance to reset if it's having issues.
+# CRX2RNX exits with 1 on errors but with 2 when it only printed warnings,
+# in which case the o file is still written and should be kept.
+CRX2RNX_WARNING_EXIT_CODE = 2
+
+# Base url of the NOAA CORS RINEX archive.
+CONST_URL = "https://noaa-cors-pds.s3.amazonaws.com/rinex"
+
+# Number of download threads. Downloads are small and spend nearly all their
+# time waiting on the network, so many more threads than CPU cores can be kept
+# busy. The connection pool below is sized to match so that threads never wait
+# on each other for a free connection.
+MAX_WORKERS = 32
+
+# I was getting errors when trying to download files, so transient failures
+# (connection errors, timeouts and 5xx responses) are retried with a backoff
+# to give the server a chance to reset. A 403 or 404 is not retried: it just
+# means the station has no file for that day.
+DOWNLOAD_RETRIES = 3
+RETRY_STATUS_CODES = {500, 502, 503, 504}
+UNAVAILABLE_STATUS_CODES = {403, 404}
+
+# Shared HTTP session. Reusing one session keeps the TCP/TLS connections to
+# the NOAA S3 bucket alive between downloads instead of reconnecting per file.
+# Every download goes to the same host, so a single host pool is enough; it
+# holds one warm connection per download thread. The S3 endpoint only speaks
+# HTTP/1.1, so an HTTP/2 client could not multiplex downloads over fewer
+# connections; keeping these connections alive is what saves the handshakes.
+SESSION = requests.Session()
+SESSION.mount("https://", HTTPAdapter(
+    pool_connections=1,
+    pool_maxsize=MAX_WORKERS,
+    max_retries=0 # Retries are handled around the whole download in download_files.
+))
+
+# Maximum number of files submitted for download but not yet finished.
+MAX_PENDING_TASKS = 4 * MAX_WORKERS
+
+# Size of the chunks read from the HTTP response while converting.
+DOWNLOAD_CHUNK_SIZE = 128 * 1024
+
+# Rough size growth of RINEX files when gunzipped and when converted from
+# Hatanaka (d) to plain (o) format. Used to reserve disk space up front; an
+# overestimate only costs space until the file is finished.
+GZIP_EXPANSION_RATIO = 3
+HATANAKA_EXPANSION_RATIO = 4
+
+
+def check_crx2rnx_exe() -> None:
+    """Error handling: ensure you have the file with the right permissions.
+
+    Called once when the script is run rather than at import time, so that
+    importing this module doesn't touch the filesystem.
     """
-    for attempt in range(retries):
-        try: 
-            response = requests.head(url, timeout=10)
-            return response.status_code == 200
-        except requests.exceptions.RequestException as e:
-            print(f'Attempt {attempt + 1} failed for url: {url}')
-            sleep(delay)
-    return False
+    assert CRX2RNX_EXE_PATH.is_file(), f"{CRX2RNX_EXE_PATH} not found. Did you copy the executable here?"
+    assert os.access(CRX2RNX_EXE_PATH, os.X_OK), f"{CRX2RNX_EXE_PATH} is not executable. Please set the permissions for this file"
 
 
 def remove_file(file_path: Path | str) -> bool:
@@ -44,73 +91,103 @@ def remove_file(file_path: Path | str) -> bool:
         return False
 
 
-def unzip_file(file_dir: str, gz_path: str) -> bool:
-    """Unzip .gz file."""
-    src = Path(file_dir) / gz_path   # convert str -> Path
-    dst = src.with_suffix('') # Strip gz from file name
-    try: 
-        dst.parent.mkdir(parents=True, exist_ok=True) # Ensure directory exists
-        with gzip.open(src, 'rb') as f_in:
-            with open(dst, 'wb') as f_out:
-                shutil.copyfileobj(f_in, f_out)
-        return True
-    except Exception as e:
-        print(f'Unzip failed for {src}: {e}')
-        return False
+@contextmanager
+def open_atomic(dst: Path | str, expected_size: int=0):
+    """Open a temporary sibling of dst for writing and move it into place.
 
+    The file only appears under its final name once it has been written
+    completely, so a run that is killed part way never leaves a partial
+    file behind that a later run would mistake for a finished one. If an
+    error occurs, the temporary file is removed instead.
 
-def handle_hatanaka_rinex(obs_file: str, data_dir: str) -> str:
-    """Convert a Hatanaka-compressed RINEX .d file to .o format if needed.
-
-    Args:
-        obs_file: The filename of the observation file.
-        data_dir: Directory where the file is located.
-
-    Returns:
-        The updated obs_file filename (converted to .o if needed).
+    If expected_size is given, that much space is reserved up front so the
+    filesystem can allocate the file in one piece rather than growing it
+    write by write. The file is cut back to what was actually written.
     """
-
-    src = Path(data_dir) / obs_file
-    if not src.name.endswith("d"):
-        return obs_file
-
-    dst = src.with_suffix(src.suffix[:-1] + "o")
-    if dst.exists():
-        return dst.name
-
+    tmp = f"{dst}.tmp"
     try:
-        subprocess.run(
-            [str(CRX2RNX_EXE_PATH), str(src.resolve())],
-            capture_output=True,
-            text=True,
-            check=True
-        ) # Excecute the crx2rnx executable to convert d to o file. 
-
-    except subprocess.CalledProcessError as e:
-        print(f'crx2rnx failed with error: {e}')
+        with open(tmp, 'wb') as f_out:
+            is_preallocated = False
+            if expected_size > 0 and hasattr(os, "posix_fallocate"): # Not available on macOS or Windows.
+                try:
+                    os.posix_fallocate(f_out.fileno(), 0, expected_size)
+                    is_preallocated = True
+                except OSError:
+                    pass # The size is only a hint, e.g. the filesystem may not support it.
+            yield f_out
+            if is_preallocated:
+                f_out.truncate() # Drop the unused part of the reservation.
+        os.replace(tmp, dst)
+    except BaseException:
+        if os.path.exists(tmp):
+            remove_file(tmp)
+        raise
+
+
+def convert_stream(response: requests.Response, dst: Path | str) -> None:
+    """Gunzip an HTTP response body and convert it to an o file as it arrives.
+
+    The decompressed Hatanaka (d) data is piped straight into CRX2RNX, which
+    writes the o file to dst, so neither the .gz nor the d file ever touches
+    the disk. CRX2RNX converts a single file per run, so one process is
+    started per download; with no file name it reads stdin and writes stdout.
 
-    if not dst.exists(): 
-        raise RuntimeError(f"{dst.name} was not created by crx2rnx")
-
-    return dst.name
+    Raises:
+        subprocess.CalledProcessError: CRX2RNX failed to convert the data.
+            Warnings are printed and the o file is kept.
+        zlib.error: The gzip data was corrupt or truncated.
+    """
+    decompressor = zlib.decompressobj(wbits=31) # 31 = expect a gzip header.
+    expected_size = int(response.headers.get("Content-Length", 0)) * GZIP_EXPANSION_RATIO * HATANAKA_EXPANSION_RATIO
+    # CRX2RNX's messages go to a temporary file rather than a pipe. Nothing
+    # reads stderr while stdin is being written, so a full stderr pipe would
+    # block both processes.
+    with open_atomic(dst, expected_size) as f_out, tempfile.TemporaryFile() as f_err:
+        with subprocess.Popen(
+            [str(CRX2RNX_EXE_PATH)],
+            stdin=subprocess.PIPE,
+            stdout=f_out,
+            stderr=f_err
+        ) as proc:
+            try:
+                try:
+                    for chunk in response.raw.stream(DOWNLOAD_CHUNK_SIZE, decode_content=False): # Keep the raw gzip bytes.
+                        proc.stdin.write(decompressor.decompress(chunk)) # Buffered, so each chunk is written in full.
+                    proc.stdin.write(decompressor.flush())
+                    proc.stdin.close() # Flushes what is left in the buffer.
+                except BrokenPipeError:
+                    # CRX2RNX exited early; its error is reported below. Close
+                    # stdin now so nothing is left buffered for Popen to flush
+                    # into the dead pipe on exit.
+                    with suppress(BrokenPipeError):
+                        proc.stdin.close()
+                returncode = proc.wait()
+                if returncode != 0:
+                    f_err.seek(0)
+                    stderr = f_err.read()
+                    if returncode != CRX2RNX_WARNING_EXIT_CODE:
+                        raise subprocess.CalledProcessError(returncode, proc.args, stderr=stderr)
+                    print(f'crx2rnx warning for {dst}: {stderr.decode(errors="replace").strip()}') # The o file is still written.
+                if not decompressor.eof:
+                    raise zlib.error(f"Truncated gzip stream for {dst}")
+            except BaseException:
+                proc.kill() # Don't leave CRX2RNX waiting on a download that failed.
+                raise
 
 
 def get_combined_url(
-    date: pd.DatetimeIndex, 
+    year_full: int, 
+    year_last_two: str, 
+    day: str, 
     station_id: str
 ) -> str:
-    """Take in date and station_id and obtain download url."""
-    download_year_full = date.year
-    download_year_last_two = f"{date.year % 100:02d}"
-    download_day = f"{date.dayofyear:03d}"
+    """Take in precomputed date parts and station_id and obtain download url.
 
-    # Command template: 
-    # 'curl -O https://noaa-cors-pds.s3.amazonaws.com/rinex/2025/001/corv/corv0010.25d.gz'
-    const_url = "https://noaa-cors-pds.s3.amazonaws.com/rinex"
-    changing_url = f"{download_year_full}/{download_day}/{station_id}/{station_id}{download_day}0.{download_year_last_two}d.gz" # Use 'o' file type instead of 'd'. 
-    combined_url = f"{const_url}/{changing_url}"
-
-    return combined_url
+    The date parts are the same for every station on a given date, so they
+    are formatted once per date by the caller.
+    """
+    # Example: https://noaa-cors-pds.s3.amazonaws.com/rinex/2025/001/corv/corv0010.25d.gz
+    return f"{CONST_URL}/{year_full}/{day}/{station_id}/{station_id}{day}0.{year_last_two}d.gz"
 
 
 def get_station_ids(
@@ -130,121 +207,152 @@ def get_station_ids(
         ValueError: The specified column is not in the CSV file. 
     """
     try:
-        df = pd.read_csv(station_id_filename)
+        header = pd.read_csv(station_id_filename, nrows=0) # Only the column names. 
     except FileNotFoundError:
         raise FileNotFoundError(f"File not found: {station_id_filename}")
     
-    if station_id_column_name in df.columns:
-        station_list = df[station_id_column_name].tolist()
-        station_ids = [x.lower() for x in station_list] # Convert all station IDs to lower case. 
-        return station_ids
-    else:
+    if station_id_column_name not in header.columns:
         raise ValueError(f"Specified station id column name '{station_id_column_name}' not present in dataset.")
 
+    df = pd.read_csv(
+        station_id_filename, 
+        usecols=[station_id_column_name], # Only parse the station id column. 
+        dtype={station_id_column_name: "string"}
+    )
+    station_ids = df[station_id_column_name].dropna() # Skip blank cells. 
+    return station_ids.str.lower().tolist() # Convert all station IDs to lower case. 
+
+
+def get_retry_delay(attempt: int, base: float=1.0, cap: float=30.0) -> float:
+    """Return the seconds to wait before retrying after failed attempt number attempt.
+
+    The delay doubles with every attempt, plus up to 50% random jitter so
+    that threads which failed together don't all retry at the same moment,
+    and is capped at cap seconds.
+    """
+    return min(cap, base * 2 ** attempt * (1 + random.random() * 0.5))
+
 
 def download_files(
     url: str, 
     download_dir: str, 
+    file_name_o: str, 
     is_silent: bool=True
 ) -> bool:
-    """Download a file using curl into the specified directory.
+    """Download a file over the shared HTTP session into the specified directory.
     
     This function will download the d.gz file format from the NOAA-CORS 
-    download url, unzip and convert the d file to an o file, and then 
-    delete the zipped and d file versions, leaving the users with
-    only o files for the date and station_id they requested. 
+    download url, then unzip and convert it to an o file as it arrives,
+    leaving the users with only o files for the date and station_id they
+    requested. 
 
     Args:
         url: The full NOAA-CORS download url
-        download_dir: Path to save the download file.
-        is_silent: If True, supress curl output in terminal.
-    
-    Raises:
-        SystemExit: If the download fails.
+        download_dir: Existing directory to save the download file in.
+        file_name_o: Name of the converted o file, e.g. p1981000.25o
+        is_silent: If True, supress download progress output in terminal.
     """
-    
-    # Check if the file exists on the server.
-    if not is_url_available(url):
-        print(f'Skipping download after retries: {url}')
-        return False
-    
-    try:
-        os.makedirs(download_dir, exist_ok=True)
-        file_name_gz = os.path.basename(url) # e.g., p1981000.25d.gz
-        file_path_gz = os.path.join(download_dir, file_name_gz)
-        file_path_d = file_path_gz[:-3] # Strip .gz
-        file_name_d = os.path.basename(file_path_d)
-        if is_silent:
-            run_list = ["curl", "-s", "-o", file_name_gz, url]
-        else: 
-            run_list = ["curl", "-o", file_name_gz, url]
-
-        subprocess.run(
-            run_list, 
-            cwd=download_dir, 
-            check=True
-        ) # Run the curl command. 
-
-    except subprocess.CalledProcessError as e:
-        print(f"File Download failed: {e}")
-        return False
-    
-    # Unzip file and delete the zipped version.
-    try:
-        unzip_file(download_dir, file_name_gz)
-        file_path_to_remove = os.path.join(download_dir, file_name_gz)
-        is_file_removed = remove_file(file_path_to_remove)
-    except Exception as e:
-        print(f"Unzipping failed: {e}")
-        return False
 
-    # Convert 'd' file to 'o' and delete the 'd' file.
-    try:
-        obs_file_o = handle_hatanaka_rinex(file_name_d, download_dir)
-        file_path_to_remove = os.path.join(download_dir, file_name_d)
-        is_file_removed = remove_file(file_path_to_remove)
-    except Exception as e:
-        print(f"Conversion failed: {e}")
-        return False
-    
-    return True # Return true if no issues occured. 
-    
+    file_path_o = os.path.join(download_dir, file_name_o)
+    if not is_silent:
+        print(f'Downloading {url}')
+
+    # The GET doubles as the availability check, so the retry loop wraps the
+    # whole download, including errors raised while streaming the body.
+    for attempt in range(DOWNLOAD_RETRIES + 1):
+        try:
+            with SESSION.get(url, stream=True, timeout=30) as response:
+                if response.status_code in UNAVAILABLE_STATUS_CODES: # File does not exist on the server.
+                    print(f'Skipping unavailable download: {url}')
+                    return False
+                if response.status_code not in RETRY_STATUS_CODES:
+                    response.raise_for_status()
+                    convert_stream(response, file_path_o) # Unzip and convert straight from the response into the o file.
+                    return True # Return true if no issues occured. 
+                error = f"{response.status_code} Server Error for url: {url}"
+
+        except (requests.exceptions.ConnectionError, 
+                requests.exceptions.Timeout, 
+                requests.exceptions.ChunkedEncodingError, 
+                urllib3.exceptions.HTTPError) as e: # The body is streamed through urllib3 directly. 
+            error = e
+        except requests.exceptions.RequestException as e:
+            print(f"File Download failed: {e}")
+            return False
+        except zlib.error as e:
+            print(f"Unzipping failed: {e}")
+            return False
+        except subprocess.CalledProcessError as e:
+            print(f'crx2rnx failed with error: {e} {e.stderr.decode(errors="replace").strip()}')
+            return False
+
+        if attempt < DOWNLOAD_RETRIES:
+            print(f'Attempt {attempt + 1} failed for url: {url}')
+            time.sleep(get_retry_delay(attempt))
+
+    print(f"File Download failed after retries: {error}")
+    return False
+
 
 def main():
-    start_download_date = pd.to_datetime("2020-4-10")
-    end_download_date = pd.to_datetime("2020-4-30")
+    start_download_date = date(2020, 4, 10)
+    end_download_date = date(2020, 4, 30)
  
-    dates_to_download_list = pd.date_range(
-        start=start_download_date, 
-        end=end_download_date
-    )
+    num_days = (end_download_date - start_download_date).days + 1
+    dates_to_download_list = [start_download_date + timedelta(days=i) for i in range(num_days)]
 
     station_id_list = get_station_ids() 
 
     # Obtaining total expected download numbers for output. 
     total_expected_downloads = len(dates_to_download_list) * len(station_id_list)
     
-    tasks = []
-    with ThreadPoolExecutor(max_workers=10) as executor:
-        for date in dates_to_download_list: # Looping throw each date and then through each station name to get data. 
-            for station in station_id_list:
-                url = get_combined_url(date, station)
-                download_dir_name = f'daily/{date.year}/{date.dayofyear:03d}'
-                tasks.append(executor.submit(download_files, url, download_dir_name)) # Appending to task array. This is used later in the code to check that all threads are finished before ending the program.
-
-        num_successful_downloads = 0
-        for task in as_completed(tasks): # Loop through completed threads and obtain output. 
-            try: 
-                if task.result():
+    # Each download is counted from a done callback, so no list of futures
+    # is kept around. The semaphore caps how many files are queued at once,
+    # keeping memory flat for long date ranges.
+    lock = threading.Lock()
+    pending_tasks = threading.BoundedSemaphore(MAX_PENDING_TASKS)
+    num_successful_downloads = 0
+    num_existing_files = 0
+
+    def on_downloaded(task):
+        nonlocal num_successful_downloads
+        try: 
+            if task.result():
+                with lock:
                     num_successful_downloads += 1
-            except Exception as e:
-                print(f'Error with thread result: {e}')
+        except Exception as e:
+            print(f'Error with thread result: {e}')
+        finally:
+            pending_tasks.release()
+
+    with ThreadPoolExecutor(max_workers=MAX_WORKERS) as executor:
+        for download_date in dates_to_download_list: # Looping throw each date and then through each station name to get data. 
+            download_year_full = download_date.year
+            download_year_last_two = f"{download_year_full % 100:02d}"
+            download_day = f"{download_date.timetuple().tm_yday:03d}"
+            download_dir_name = f'daily/{download_year_full}/{download_day}'
+            os.makedirs(download_dir_name, exist_ok=True) # Create each date directory once, not once per download.
+            for station in station_id_list:
+                file_name_o = f"{station}{download_day}0.{download_year_last_two}o" # e.g., p1981000.25o
+
+                # Skip files already downloaded and converted by a previous run.
+                if os.path.exists(os.path.join(download_dir_name, file_name_o)):
+                    num_existing_files += 1
+                    continue
+
+                url = get_combined_url(download_year_full, download_year_last_two, download_day, station)
+                pending_tasks.acquire() # Wait for room before queueing another file.
+                task = executor.submit(download_files, url, download_dir_name, file_name_o)
+                task.add_done_callback(on_downloaded)
 
 
     # Printing Metrics
     print(f"Downloading Completed!")
     print(f"Downloaded {num_successful_downloads} of {total_expected_downloads}")
+    if num_existing_files:
+        print(f"Skipped {num_existing_files} files that were already downloaded")
     
 
 if __name__ == "__main__":
+    check_crx2rnx_exe()
     main()
\ No newline at end of file